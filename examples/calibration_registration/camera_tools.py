@@ -13,9 +13,9 @@ Copyright (C) Microsoft Corporation. All rights reserved.
 
 # Standard imports.
 import os
-import fnmatch
+import functools
 import json
-import math
+import multiprocessing
 import time
 import warnings
 
@@ -31,6 +31,14 @@ from cv2 import aruco_CharucoBoard
 from cv2 import aruco_DetectorParameters as detect_params
 import numpy as np
 
+# Board object and options shared by the detection worker processes.
+_BOARD = None
+_REDUCED_FIRST_PASS = False
+
+# Detector parameters used when the caller does not supply any.
+_DEFAULT_PARAMS = aruco.DetectorParameters_create()
+_DEFAULT_PARAMS.cornerRefinementMethod = aruco.CORNER_REFINE_NONE
+
 #-------------------------------------------------------------------------------
 class CalibrationError(Exception):
   """Error during calibration.
@@ -49,16 +57,35 @@ class RTMatrix():
   translation:List
 
 
+#-------------------------------------------------------------------------------
+def _json_default(obj):
+  """Convert numpy values that the json module cannot serialize.
+
+  Args:
+    obj: Object the json encoder does not handle.
+
+  Raises:
+    TypeError: Object is not a numpy array or scalar.
+
+  Returns:
+    Python list or scalar equivalent of obj.
+  """
+  if isinstance(obj, (np.ndarray, np.generic)):
+    return obj.tolist()
+  raise TypeError(f"Object of type {type(obj).__name__} is not JSON "
+                  "serializable")
+
 #-------------------------------------------------------------------------------
 def write_json(json_file:str, data:dict)-> None:
-  """Helper function for writing out json files.
+  """Helper function for writing out json files. Numpy arrays and scalars are
+  written as lists and numbers.
 
   Args:
     json_file (str): full path
     data (dict): Blob of data to write.
   """
   with open(json_file, "w") as j:
-    json.dump(data, j, indent=4)
+    json.dump(data, j, indent=4, default=_json_default)
 
 #-------------------------------------------------------------------------------
 def r_as_matrix(rotation:np.array):
@@ -70,11 +97,11 @@ def r_as_matrix(rotation:np.array):
   Returns:
     [np.array]: Rotation matrix.
   """
-  rmat = np.zeros(shape=(3,3))
-  cv2.Rodrigues(rotation, rmat)
+  rmat, _ = cv2.Rodrigues(np.asarray(rotation, dtype=np.float64))
   return rmat
 
 #-------------------------------------------------------------------------------
+@functools.lru_cache(maxsize=32)
 def read_opencv_calfile(calfile:str) -> Tuple[np.ndarray,
                                               np.ndarray,
                                               np.ndarray]:
@@ -92,6 +119,7 @@ def read_opencv_calfile(calfile:str) -> Tuple[np.ndarray,
       k_matrix: The camera intrinsics matrix.
       dist: the distortion matrix.
       img_size: Image size as ndarray objects, in the order width, height.
+      Results are cached per path, so the arrays are read-only.
   """
   fs_calib = cv2.FileStorage(calfile, cv2.FILE_STORAGE_READ)
   if not fs_calib.isOpened():
@@ -101,6 +129,10 @@ def read_opencv_calfile(calfile:str) -> Tuple[np.ndarray,
   dist = fs_calib.getNode("dist").mat()
   img_size = fs_calib.getNode("img_size").mat()
   fs_calib.release()
+
+  k_matrix.setflags(write=False)
+  dist.setflags(write=False)
+  img_size.setflags(write=False)
   return k_matrix, dist, img_size
 
 #-------------------------------------------------------------------------------
@@ -122,6 +154,9 @@ def write_opencv_calfile(calfile:str,
   fs_calib.write("img_size", img_size)
   fs_calib.release()
 
+  # Drop any cached copy of a file that has just been rewritten.
+  read_opencv_calfile.cache_clear()
+
 #-------------------------------------------------------------------------------
 def write_calibration_blob(calibrations:List[str],
                rmat_b_to_a:np.array,
@@ -138,14 +173,19 @@ def write_calibration_blob(calibrations:List[str],
 
   blob = {"CalibrationInformation":{"Cameras":[]}}
 
+  # RT for the camera used as the origin for all others.
+  origin_r = [1,0,0,0,1,0,0,0,1]
+  origin_t = [0,0,0]
+  flat_r = rmat_b_to_a.ravel()
+  flat_t = tvec_b_to_a.ravel()
+
   for idx, calibration_file in enumerate(calibrations):
     if idx == 0:
-      # RT for the camera used as the origin for all others.
-      reshape_r = [1,0,0,0,1,0,0,0,1]
-      reshape_t = [0,0,0]
+      reshape_r = origin_r
+      reshape_t = origin_t
     else:
-      reshape_r = rmat_b_to_a.reshape(9, 1).squeeze(1).tolist()
-      reshape_t = tvec_b_to_a.squeeze(1).tolist()
+      reshape_r = flat_r
+      reshape_t = flat_t
 
     camera_matrix, dist, img_size = read_opencv_calfile(calibration_file)
     intrinsics = [camera_matrix[0][2]/img_size[0][0], #Px
@@ -171,8 +211,8 @@ def write_calibration_blob(calibrations:List[str],
     extrinsics = {"Rotation":reshape_r, "Translation":reshape_t}
     calibration = {"Intrinsics":intrinsics_data,
             "Rt":extrinsics,
-            "SensorHeight":img_size[1].tolist(),
-            "SensorWidth":img_size[0].tolist()}
+            "SensorHeight":img_size[1],
+            "SensorWidth":img_size[0]}
 
     blob["CalibrationInformation"]["Cameras"].append(calibration)
 
@@ -181,6 +221,7 @@ def write_calibration_blob(calibrations:List[str],
   write_json(json_file, blob)
 
 #-------------------------------------------------------------------------------
+@functools.lru_cache(maxsize=8)
 def read_board_parameters(json_file: str) -> Tuple[Dict, aruco_CharucoBoard]:
   """Read charuco board from a json file.
 
@@ -191,6 +232,7 @@ def read_board_parameters(json_file: str) -> Tuple[Dict, aruco_CharucoBoard]:
     Tuple[dict, aruco_CharucoBoard]:
       target: Target data from json_file.
       board: A single charuco board object.
+      Results are cached per path and shared between callers.
   """
 
   with open(json_file) as j_file:
@@ -218,18 +260,19 @@ def get_image_points(board:aruco_CharucoBoard,
     marker_ids (np.ndarray): List of detected charuco marker Ids.
 
   Returns:
-    np.ndarray: numpy array (n*1*3) markers 3d positions.
+    np.ndarray: numpy array (n*3) markers 3d positions.
   """
 
-  object_points = board.chessboardCorners[marker_ids, :]
+  object_points = board.chessboardCorners[marker_ids.ravel()]
   return object_points
 
 #-------------------------------------------------------------------------------
 def detect_markers(img: np.ndarray,
                    template: str,
-                   params:detect_params = None) -> Tuple[List[np.ndarray],
-                                                         List[np.ndarray],
-                                                         aruco_CharucoBoard]:
+                   params:detect_params = None,
+                   board:aruco_CharucoBoard = None) -> Tuple[List[np.ndarray],
+                                                             List[np.ndarray],
+                                                             aruco_CharucoBoard]:
   """Detect board markers.
 
   Args:
@@ -237,6 +280,8 @@ def detect_markers(img: np.ndarray,
     template (str): fullpath of the board json_file.
     params (aruco_DetectorParameters, optional): a cv2 object
       aruco_DetectorParameters. Defaults to None.
+    board (aruco_CharucoBoard, optional): Board already read from template.
+      Defaults to None, in which case the template is read.
 
   Returns:
     Tuple[List[np.ndarray], List[np.ndarray], aruco_CharucoBoard]:
@@ -245,28 +290,26 @@ def detect_markers(img: np.ndarray,
       board: charucoboard object.
   """
   # detect markers
-  _, board = read_board_parameters(template)
+  if board is None:
+    _, board = read_board_parameters(template)
 
   if params is None:
-    params = aruco.DetectorParameters_create()
-    params.cornerRefinementMethod = aruco.CORNER_REFINE_NONE
+    params = _DEFAULT_PARAMS
 
   aruco_corners, aruco_ids, _ = aruco.detectMarkers(img,
                             board.dictionary,
                             None,
                             None,
                             params)
+  charuco_corners = None
+  charuco_ids = None
   if len(aruco_corners) > 0:
     _, charuco_corners, charuco_ids = aruco.interpolateCornersCharuco(
                                       aruco_corners,
                                       aruco_ids,
                                       img,
                                       board)
-    if charuco_corners is None:
-      charuco_corners = []
-      charuco_ids = []
-      warnings.warn("No charuco corners detected in image.")
-  else:
+  if charuco_corners is None:
     charuco_corners = []
     charuco_ids = []
     warnings.warn("No charuco corners detected in image.")
@@ -274,7 +317,64 @@ def detect_markers(img: np.ndarray,
   return charuco_corners, charuco_ids, board
 
 #-------------------------------------------------------------------------------
-def detect_markers_many_images(imgnames:List[str], template: str):
+def _init_worker(template: str, reduced_first_pass: bool) -> None:
+  """Read the board once per worker process.
+
+  Args:
+    template (str): Template file json of the board.
+    reduced_first_pass (bool): Reject images on a half resolution decode.
+  """
+  global _BOARD, _REDUCED_FIRST_PASS
+  _, _BOARD = read_board_parameters(template)
+  _REDUCED_FIRST_PASS = reduced_first_pass
+
+#-------------------------------------------------------------------------------
+def _process_one(imgfile: str) -> Tuple[np.ndarray,
+                                        np.ndarray,
+                                        np.ndarray,
+                                        np.ndarray]:
+  """Detect markers in a single image. Run inside a worker process.
+
+  Args:
+    imgfile (str): Full path to image.
+
+  Returns:
+    Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: charuco corners,
+      charuco ids, 3d marker positions and image size [width, height], or None
+      if the image could not be read or too few markers were detected.
+  """
+  if _REDUCED_FIRST_PASS:
+    # JPEG images are decoded at half size, so images without the board are
+    # rejected before a full resolution decode. Other formats are decoded in
+    # full and then resized, so this only pays off for JPEG.
+    img_half = cv2.imread(imgfile, cv2.IMREAD_REDUCED_GRAYSCALE_2)
+    if img_half is None:
+      return None
+    aruco_corners, _, _ = aruco.detectMarkers(img_half,
+                                              _BOARD.dictionary,
+                                              None,
+                                              None,
+                                              _DEFAULT_PARAMS)
+    if len(aruco_corners) == 0:
+      return None
+
+  # Corners are always located on the full resolution image.
+  img = cv2.imread(imgfile, cv2.IMREAD_GRAYSCALE)
+  if img is None:
+    return None
+
+  ccorners, cids, board = detect_markers(img, None, board=_BOARD)
+  if len(ccorners) <= 3:
+    return None
+
+  m3d = get_image_points(board, cids)
+  sizes = np.array([img.shape[1], img.shape[0]])
+  return ccorners, cids, m3d, sizes
+
+#-------------------------------------------------------------------------------
+def detect_markers_many_images(imgnames:List[str],
+                               template: str,
+                               reduced_first_pass: bool = False):
   """
   Run detect_markers on a large set of png or jpeg images in a single directory,
   with the assumption that all images are viewing the same board.
@@ -282,6 +382,10 @@ def detect_markers_many_images(imgnames:List[str], template: str):
   Args:
     imgnames (List[str]):Full path to images.
     template (str): Template file json of the board.
+    reduced_first_pass (bool, optional): Skip images in which no markers are
+      found at half resolution. Small or distant boards may be missed, and
+      images that pass are decoded twice, so this only helps JPEG data sets
+      where many images do not show the board. Defaults to False.
 
   Raises:
     CalibrationError: Not all image sizes are equal.
@@ -297,7 +401,7 @@ def detect_markers_many_images(imgnames:List[str], template: str):
       ccorners_all: All chauco corners detected in every image.
       cids_all: All charuco marker ids detected in every image.
       p3d: Image points.
-      img_size: [width; height].
+      img_size: [width; height], None if no image had enough detections.
       board: Charucoboard object.
   """
   ccorners_all = []
@@ -305,27 +409,33 @@ def detect_markers_many_images(imgnames:List[str], template: str):
   p3d = []
   img_sizes_all = []
 
-  for imgfile in imgnames:
-    img = cv2.imread(imgfile, cv2.IMREAD_GRAYSCALE)
-    if img is not None:
-      ccorners, cids, board = detect_markers(img, template)
+  _, board = read_board_parameters(template)
 
-      if len(ccorners) > 3:
-        ccorners_all.append(ccorners)
-        cids_all.append(cids)
-        m3d = get_image_points(board, cids)
-        p3d.append(m3d)
-        sizes = np.array([img.shape[1], img.shape[0]])
-        img_sizes_all.append(sizes)
+  # Images are independent, so reading and detection are spread across all
+  # cores.
+  with multiprocessing.Pool(os.cpu_count(),
+                            initializer=_init_worker,
+                            initargs=(template, reduced_first_pass)) as pool:
+    results = pool.map(_process_one, imgnames, chunksize=4)
+
+  for result in results:
+    if result is not None:
+      ccorners, cids, m3d, sizes = result
+      ccorners_all.append(ccorners)
+      cids_all.append(cids)
+      p3d.append(m3d)
+      img_sizes_all.append(sizes)
+
+  # Nothing detected, leave reporting to the caller's detection count check.
+  if not img_sizes_all:
+    return ccorners_all, cids_all, p3d, None, board
 
   # check all images sizes are identical.
-  rows_equal = [elem[0]==img_sizes_all[0][0] for elem in img_sizes_all]
-  cols_equal = [elem[1]==img_sizes_all[0][1] for elem in img_sizes_all]
-
-  if not all(rows_equal) or not all(cols_equal):
+  sizes_arr = np.stack(img_sizes_all, axis=0)
+  if not np.all(sizes_arr == sizes_arr[0]):
     raise CalibrationError("Not all image sizes in data set are the same.")
 
-  img_size = (img_sizes_all[0][0], img_sizes_all[0][1])
+  img_size = (sizes_arr[0][0], sizes_arr[0][1])
   return ccorners_all, cids_all, p3d, img_size, board
 
 #-------------------------------------------------------------------------------
@@ -414,22 +524,42 @@ def unproject(points:np.array, k_mat:np.array, dist:np.array) -> np.array:
     np.array: 3D Normalized coordinates of markers after unprojection.
   """
 
-  principal_point = [k_mat[0][2], k_mat[1][2]]
-  focal_length = [k_mat[0][0], k_mat[1][1]]
-
+  # Iteration stops once the epsilon is reached; the count only bounds points
+  # that converge slowly, e.g. near the edge of wide field of view lenses.
   term_criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT,
-                   400,
+                   100,
                    0.000001)
-  x_u = cv2.undistortPointsIter(points,
-                                k_mat,
-                                dist,
-                                np.eye(3),
-                                k_mat,
-                                term_criteria)
-
-  rays = (x_u-principal_point)/focal_length
+
+  # Without a new projection matrix the points come back normalized.
+  rays = cv2.undistortPointsIter(points,
+                                 k_mat,
+                                 dist,
+                                 None,
+                                 None,
+                                 term_criteria)
   return rays
 
+#-------------------------------------------------------------------------------
+def _angle_rms(measured:np.ndarray, prediction:np.ndarray) -> float:
+  """Root mean square of the angles between measured and predicted rays.
+
+  Args:
+    measured (np.ndarray): (N, 2) normalized coordinates of detected markers.
+    prediction (np.ndarray): (N, 2) normalized coordinates of projected markers.
+
+  Returns:
+    float: Root mean square of the angles in radians.
+  """
+  # Rays (x, y, 1) of every marker, compared all at once.
+  ones = np.ones((measured.shape[0], 1))
+  meas = np.hstack([measured, ones])
+  pred = np.hstack([prediction, ones])
+
+  dots = np.einsum("ij,ij->i", meas, pred)
+  norms = np.linalg.norm(meas, axis=1) * np.linalg.norm(pred, axis=1)
+  angles = np.arccos(np.clip(dots / norms, -1.0, 1.0))
+  return float(np.sqrt(np.mean(angles**2)))
+
 #-------------------------------------------------------------------------------
 def registration_error(array_a:np.array,
              template:str,
@@ -471,14 +601,23 @@ def registration_error(array_a:np.array,
   # Get 2d image coordinates of markers detected in camera A.
   corners_a, ids_a, board = detect_markers(array_a, template)
 
-  # 3D board points in coordinates of camera B.
-  points_board = board.chessboardCorners[ids_a, :]
-  squoze = points_board.squeeze(1)
-  markers_cam_b = np.matmul(r_as_matrix(pose_b.rotation),
-                            squoze.transpose()) + pose_b.translation
+  # 3D board points.
+  points_board = get_image_points(board, ids_a)
+  squoze = np.ascontiguousarray(points_board, dtype=np.float64)
+
+  # Board to camera B, then registration of camera B to camera A, composed
+  # into a single homogeneous transform.
+  board_to_b = np.eye(4)
+  board_to_b[:3, :3] = r_as_matrix(pose_b.rotation)
+  board_to_b[:3, 3:] = np.reshape(pose_b.translation, (3, 1))
+  b_to_a = np.eye(4)
+  b_to_a[:3, :3] = rmat_b_to_a
+  b_to_a[:3, 3:] = np.reshape(tvec_b_to_a, (3, 1))
+  board_to_a = b_to_a @ board_to_b
 
-  # Multiply by registration to get markers 3D coordinates in camera A.
-  pts_in_cam_a = np.matmul(rmat_b_to_a, markers_cam_b) + tvec_b_to_a
+  # Markers 3D coordinates in camera A.
+  points_h = np.hstack([squoze, np.ones((squoze.shape[0], 1))])
+  pts_in_cam_a = (board_to_a @ points_h.T)[:3]
 
   # Registration computed 3D points to 2D image plane A.
   k_mat, dist, _ = read_opencv_calfile(calib_a)
@@ -489,28 +628,17 @@ def registration_error(array_a:np.array,
                              dist)
 
   # Express difference between measured and projected as radians.
-  angles = []
-  measured = unproject(corners_a, k_mat, dist)
-  prediction = unproject(pts, k_mat, dist)
-
-  for idx, elem in enumerate(measured):
-    meas = [elem[0][0], elem[0][1], 1]
-    pred = [prediction[idx][0][0], prediction[idx][0][1], 1]
-
-    dot_product = np.dot(meas, pred)
-    norm_a = np.linalg.norm(meas)
-    norm_b = np.linalg.norm(pred)
-    theta = math.acos(dot_product / (norm_a * norm_b))
-    angles.append(theta)
+  measured = unproject(corners_a, k_mat, dist).reshape(-1, 2)
+  prediction = unproject(pts, k_mat, dist).reshape(-1, 2)
 
   # Get Root Mean Square of measured points in camera A to registration
   # calculated points.
-  num_points = pts.shape[0]
-  squares = [elem**2 for elem in angles]
-  rms_radians = math.sqrt(sum(squares)/num_points)
+  rms_radians = _angle_rms(measured, prediction)
   print(f"RMS (Radians): {rms_radians}")
 
-  rms_pixels = np.sqrt(np.sum((corners_a-pts)**2)/num_points)
+  num_points = pts.shape[0]
+  diff = corners_a.reshape(-1, 2) - pts.reshape(-1, 2)
+  rms_pixels = float(np.sqrt(np.einsum("ij,ij->", diff, diff) / num_points))
   return rms_pixels, rms_radians
 
 #-------------------------------------------------------------------------------
@@ -569,10 +697,9 @@ def calibrate_camera(
   # output cal file
   calfile = os.path.join(imdir, f"calib{postfix}.yml")
 
-  imgnames = []
-  for file in os.listdir(imdir):
-    if fnmatch.fnmatch(file, "*.png") or fnmatch.fnmatch(file, "*.jpg"):
-      imgnames.append(os.path.join(imdir, file))
+  # Sorted so that perViewErrors indices are reproducible.
+  imgnames = sorted(os.path.join(imdir, file) for file in os.listdir(imdir)
+                    if file.lower().endswith((".png", ".jpg", ".jpeg")))
 
   num_images = len(imgnames)
   if num_images < min_images:
@@ -595,6 +722,9 @@ def calibrate_camera(
     dist = np.zeros((8, 1),  dtype=np.float32)
   else:
     k_matrix, dist, img_data = read_opencv_calfile(init_calfile)
+    # Cached arrays are read-only, the calibration refines its own copy.
+    k_matrix = k_matrix.copy()
+    dist = dist.copy()
     img_arr = img_data.astype(int)
     img_size = (img_arr[0][0], img_arr[1][0])
 
@@ -613,16 +743,14 @@ def calibrate_camera(
                            criteria=criteria)
 
   # Check Quality of each image.
-  n_low_rms = [err[0] for err in perViewErrors if err[0] <= per_view_threshold]
-  num_good_images = len(n_low_rms)
+  errs = np.asarray(perViewErrors).ravel()
+  num_good_images = int((errs <= per_view_threshold).sum())
 
   # Report which indexes are failing in perViewErrors.
-  failing_idxs = []
-  [failing_idxs.append(str(index)) for (index, err) in enumerate(perViewErrors) if err[0] > per_view_threshold]
-  warning_failing_indexes = "Failing image indices: " + ", ".join(failing_idxs)
-
-  if len(failing_idxs) != 0:
-    warnings.warn(warning_failing_indexes)
+  failing_idxs = np.where(errs > per_view_threshold)[0]
+  if failing_idxs.size != 0:
+    warnings.warn("Failing image indices: " +
+                  ", ".join(map(str, failing_idxs.tolist())))
 
   if num_good_images < min_quality_images:
     msg = f"Insufficent number of quality images. " \
@@ -709,8 +837,12 @@ def register(img_a: str,
   rmat_b = r_as_matrix(pose_b.rotation)
 
   # Get perspective of camera B to board.
-  rmat_b_to_a = np.matmul(rmat_a, rmat_b.transpose())
-  tvec_b_to_a = -np.matmul(rmat_b_to_a, pose_b.translation) + pose_a.translation
+  rmat_b_to_a = rmat_a @ rmat_b.T
+  tvec_b_to_a = pose_a.translation - rmat_b_to_a @ pose_b.translation
+
+  # Inverse registration, camera A to camera B.
+  rmat_a_to_b = rmat_b_to_a.T
+  tvec_a_to_b = -rmat_a_to_b @ tvec_b_to_a
 
   print(f"Translation camera B to A:\n{tvec_b_to_a}")
   print(f"Rotation camera B to A:\n{rmat_b_to_a}")
@@ -732,8 +864,8 @@ def register(img_a: str,
                          template,
                          calib_b,
                          pose_a,
-                         rmat_b_to_a.transpose(),
-                         rmat_b_to_a.transpose() @ tvec_b_to_a*-1)
+                         rmat_a_to_b,
+                         tvec_a_to_b)
   if rms2_rad > rms_threshold:
     raise RegistrationError("Registration error from B to A too large.")
 